@@ -5,14 +5,22 @@ Analyzes absorbent-analyte complexes using FairChem and GemNet models
 """
 
 import os
+import copy
+import contextlib
+from collections import OrderedDict
+import hashlib
+import struct
+import tempfile
 import numpy as np
 import torch
 import warnings
 warnings.filterwarnings('ignore')
 
 from ase import Atoms
-from ase.io import read
-from ase.optimize import BFGS
+from ase.calculators.calculator import all_changes
+from ase.data import chemical_symbols
+from ase.io import read, write
+from ase.optimize import BFGS, FIRE
 
 try:
     from fairchem.core.common.relaxation.ase_utils import OCPCalculator
@@ -20,6 +28,9 @@ except ImportError:
     print("Warning: fairchem-core not installed. Install with: pip install fairchem-core")
     OCPCalculator = None
 
+OPTIMIZERS = {'bfgs': BFGS, 'fire': FIRE}
+PROPERTIES_CACHE_SIZE = 128
+
 class MolecularComplexAnalyzer:
     """
     Complete pipeline for molecular complex analysis:
@@ -28,16 +39,35 @@ class MolecularComplexAnalyzer:
     - Property prediction
     """
     
-    def __init__(self, fairchem_model="gemnet_oc", device="cuda" if torch.cuda.is_available() else "cpu"):
+    def __init__(self, fairchem_model="gemnet_oc", device=None,
+                 autocast_dtype=None, compile_model=False, cache_dir=None, property_noise=False):
         """
         Initialize analyzer
         
         Args:
             fairchem_model: FairChem model name
-            device: 'cuda' or 'cpu'
+            device: 'cuda' or 'cpu' (default: cuda when available)
+            autocast_dtype: Optional reduced-precision dtype for model inference
+                            (e.g. torch.bfloat16), None for full FP32
+            compile_model: Compile the model forward with torch.compile
+            cache_dir: Directory for cached optimized structures (disabled when None)
+            property_noise: Add seeded Gaussian noise to the empirical gap and
+                            binding-energy estimates
         """
-        self.device = device
+        # Resolved here rather than in the signature so importing this module
+        # does not initialize CUDA (worker processes pin their GPU first)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
         self.fairchem_model = fairchem_model
+        self.autocast_dtype = autocast_dtype
+        self.compile_model = compile_model
+        self.cache_dir = cache_dir
+        self.property_noise = property_noise
+        self._properties_cache = OrderedDict()
+        
+        # van der Waals radii indexed by atomic number (default 1.5 Å)
+        self._vdw_table = np.full(119, 1.5)
+        self._vdw_table[[1, 6, 7, 8, 16, 15]] = [1.2, 1.7, 1.55, 1.52, 1.8, 1.8]
+        
         self.setup_models()
     
     def setup_models(self):
@@ -48,17 +78,53 @@ class MolecularComplexAnalyzer:
                 self.fairchem_calc = None
                 return
             
+            if torch.device(self.device).type == "cuda":
+                # Route FP32 matmuls/convolutions through TF32 tensor cores
+                torch.set_float32_matmul_precision('high')
+                torch.backends.cuda.matmul.allow_tf32 = True
+                torch.backends.cudnn.allow_tf32 = True
+            
             self.fairchem_calc = OCPCalculator(
                 model_name=self.fairchem_model,
                 local_cache="./models/",
                 cpu=(self.device == "cpu")
             )
+            if self.compile_model:
+                self._compile_calculator()
             print(f"✓ Models initialized: {self.fairchem_model} on {self.device}")
             
         except Exception as e:
             print(f"Error initializing models: {e}")
             self.fairchem_calc = None
     
+    def _compile_calculator(self):
+        """Replace the FairChem model forward with a torch.compile'd version"""
+        trainer = self.fairchem_calc.trainer
+        eager_model = trainer.model
+        try:
+            # No CUDA graphs: the radius graph changes size between relaxation steps,
+            # so every new edge count would record (and keep) another graph
+            trainer.model = torch.compile(eager_model, mode="default", fullgraph=False, dynamic=True)
+            
+            # torch.compile is lazy; run one forward so compile errors surface here
+            water = Atoms('OH2', positions=[[0.0, 0.0, 0.119], [0.0, 0.757, -0.476], [0.0, -0.757, -0.476]])
+            with self._autocast():
+                self.fairchem_calc.calculate(water, properties=['energy', 'forces'],
+                                             system_changes=all_changes)
+            print("✓ Model compiled")
+        except Exception as e:
+            trainer.model = eager_model
+            print(f"torch.compile failed, using eager model: {e}")
+        finally:
+            # Don't let the warm-up water look like a cached result for real structures
+            self.fairchem_calc.reset()
+    
+    def _autocast(self):
+        """Mixed-precision context for model inference"""
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=torch.device(self.device).type, dtype=self.autocast_dtype)
+    
     def parse_gjf_file(self, filepath):
         """
         Parse Gaussian .gjf file
@@ -78,12 +144,10 @@ class MolecularComplexAnalyzer:
     
     def _manual_gjf_parse(self, filepath):
         """Manual .gjf parser"""
-        symbols = []
-        positions = []
-        
         with open(filepath, 'r') as f:
             lines = f.readlines()
         
+        rows = []
         coord_section = False
         for line in lines:
             line = line.strip()
@@ -91,31 +155,43 @@ class MolecularComplexAnalyzer:
             if not line or line.startswith('#') or line.startswith('%'):
                 continue
             
-            if coord_section and line:
-                parts = line.split()
-                if len(parts) >= 4:
-                    try:
-                        symbols.append(parts[0])
-                        positions.append([float(parts[1]), float(parts[2]), float(parts[3])])
-                    except (ValueError, IndexError):
-                        continue
-            elif line and not coord_section:
-                if any(char.isdigit() for char in line) and any(char.isalpha() for char in line):
-                    coord_section = True
-                    parts = line.split()
-                    if len(parts) >= 4:
-                        try:
-                            symbols.append(parts[0])
-                            positions.append([float(parts[1]), float(parts[2]), float(parts[3])])
-                        except (ValueError, IndexError):
-                            continue
-        
-        if symbols and positions:
+            if not coord_section:
+                if not (any(char.isdigit() for char in line) and any(char.isalpha() for char in line)):
+                    continue
+                coord_section = True
+            
+            parts = line.split()
+            if len(parts) >= 4:
+                rows.append(parts)
+        
+        symbols, positions = self._parse_coord_rows(rows)
+        
+        if symbols:
             return Atoms(symbols=symbols, positions=positions)
         else:
             raise ValueError("Could not parse coordinates from .gjf file")
     
-    def optimize_structure(self, atoms, fmax=0.05, steps=200):
+    def _parse_coord_rows(self, rows):
+        """Convert tokenized coordinate rows into symbols and an (N, 3) array"""
+        try:
+            # Fast path: one C-level string-to-float conversion for all atoms
+            positions = np.array([parts[1:4] for parts in rows], dtype=np.float64).reshape(-1, 3)
+            return [parts[0] for parts in rows], positions
+        except ValueError:
+            pass
+        
+        symbols = []
+        positions = []
+        for parts in rows:
+            try:
+                xyz = [float(parts[1]), float(parts[2]), float(parts[3])]
+            except ValueError:
+                continue
+            symbols.append(parts[0])
+            positions.append(xyz)
+        return symbols, np.array(positions, dtype=np.float64).reshape(-1, 3)
+    
+    def optimize_structure(self, atoms, fmax=0.05, steps=200, optimizer="bfgs", trajectory=None):
         """
         Optimize molecular structure
         
@@ -123,28 +199,95 @@ class MolecularComplexAnalyzer:
             atoms: ASE Atoms object
             fmax: Force convergence threshold
             steps: Maximum optimization steps
+            optimizer: 'bfgs' or 'fire' (O(N) per step, no Hessian)
+            trajectory: Path to record every step to (and log steps to stdout);
+                        the file belongs to the caller, e.g. a path under /dev/shm.
+                        None keeps no history.
             
         Returns:
             Optimized atoms
         """
+        if optimizer not in OPTIMIZERS:
+            raise ValueError(f"Unknown optimizer '{optimizer}', expected one of: {', '.join(OPTIMIZERS)}")
+        
         if self.fairchem_calc is None:
             print("Warning: No calculator available, returning unoptimized structure")
             return atoms
         
+        cache_path = self._optimization_cache_path(atoms, fmax, steps, optimizer)
+        # A requested trajectory needs the steps to actually run
+        if cache_path and trajectory is None and os.path.exists(cache_path):
+            try:
+                cached = read(cache_path, format='traj')
+                print("✓ Optimized structure loaded from cache")
+                return self._attach_cached_results(cached)
+            except Exception as e:
+                print(f"Ignoring unreadable cache entry {cache_path}: {e}")
+        
         try:
             atoms_copy = atoms.copy()
             atoms_copy.set_calculator(self.fairchem_calc)
             
-            optimizer = BFGS(atoms_copy, trajectory=f'opt_{id(atoms)}.traj')
-            optimizer.run(fmax=fmax, steps=steps)
+            opt = OPTIMIZERS[optimizer](atoms_copy, trajectory=trajectory,
+                                        logfile='-' if trajectory else None)
+            with self._autocast():
+                opt.run(fmax=fmax, steps=steps)
+            
+            print(f"✓ Optimization completed in {opt.get_number_of_steps()} steps")
+            if trajectory:
+                print(f"   Trajectory: {trajectory}")
             
-            print(f"✓ Optimization completed in {optimizer.get_number_of_steps()} steps")
+            if cache_path:
+                self._write_cache(cache_path, atoms_copy)
             return atoms_copy
             
         except Exception as e:
             print(f"Optimization failed: {e}")
             return atoms
     
+    def _attach_cached_results(self, atoms):
+        """Attach the live calculator to a cached structure, primed with its stored results"""
+        stored = atoms.calc.results if atoms.calc is not None else {}
+        atoms.set_calculator(self.fairchem_calc)
+        if 'energy' in stored and 'forces' in stored:
+            # Same state the calculator is left in after a fresh relaxation
+            self.fairchem_calc.atoms = atoms.copy()
+            self.fairchem_calc.results = {'energy': stored['energy'], 'forces': stored['forces']}
+        return atoms
+    
+    def _write_cache(self, cache_path, atoms):
+        """Store an optimized structure; failures only cost the cache entry"""
+        tmp_path = None
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Private temp file per writer, renamed into place atomically
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.traj')
+            os.close(fd)
+            write(tmp_path, atoms, format='traj')
+            os.replace(tmp_path, cache_path)
+        except Exception as e:
+            print(f"Warning: could not cache optimized structure: {e}")
+            if tmp_path and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    
+    def _optimization_cache_path(self, atoms, fmax, steps, optimizer):
+        """Cache file for an optimization of this structure, keyed on geometry and settings"""
+        if not self.cache_dir:
+            return None
+        # + 0.0 folds -0.0 into 0.0 so equal geometries hash identically
+        positions = np.round(atoms.get_positions(), 4) + 0.0
+        cell = np.round(atoms.cell.array, 4) + 0.0
+        key = hashlib.blake2b(
+            np.asarray(atoms.numbers, dtype=np.int64).tobytes()
+            + positions.tobytes()
+            + cell.tobytes()
+            + np.asarray(atoms.pbc, dtype=np.uint8).tobytes()
+            + np.asarray(atoms.get_tags(), dtype=np.int64).tobytes()
+            + struct.pack('di', fmax, steps)
+            + f"{self.fairchem_model}:{optimizer}:{self.autocast_dtype}".encode()
+        ).hexdigest()
+        return os.path.join(self.cache_dir, f"{key}.traj")
+    
     def create_complex(self, absorbent, analyte, separation_distance=3.0):
         """
         Create absorbent-analyte complex
@@ -157,138 +300,178 @@ class MolecularComplexAnalyzer:
         Returns:
             Combined complex atoms
         """
-        abs_com = absorbent.get_center_of_mass()
-        ana_com = analyte.get_center_of_mass()
+        abs_masses = absorbent.get_masses()
+        ana_masses = analyte.get_masses()
+        abs_com = abs_masses @ absorbent.positions / abs_masses.sum()
+        ana_com = ana_masses @ analyte.positions / ana_masses.sum()
         
-        analyte_copy = analyte.copy()
         displacement = np.array([0, 0, separation_distance]) + abs_com - ana_com
-        analyte_copy.translate(displacement)
         
-        complex_atoms = absorbent + analyte_copy
+        # Same result as absorbent + translated analyte copy (constraints, cell, pbc,
+        # info and every per-atom array), without materializing the analyte copy
+        complex_atoms = absorbent.copy()
+        complex_atoms.extend(analyte)
+        complex_atoms.positions[len(absorbent):] += displacement
         
         return complex_atoms
     
-    def optimize_complex(self, complex_atoms, fmax=0.05, steps=300):
+    def optimize_complex(self, complex_atoms, fmax=0.05, steps=300, optimizer="bfgs", trajectory=None):
         """Optimize complex structure"""
-        return self.optimize_structure(complex_atoms, fmax, steps)
+        return self.optimize_structure(complex_atoms, fmax, steps, optimizer, trajectory)
     
-    def calculate_properties(self, complex_atoms):
+    def calculate_properties(self, complex_atoms, compute_forces=True):
         """
         Calculate molecular properties
         
         Args:
             complex_atoms: Optimized complex
+            compute_forces: Include forces_rms (needs forces, not just energy)
             
         Returns:
             Dictionary of properties
         """
+        digest = self._structure_hash(complex_atoms)
+        cache_key = (digest, compute_forces)
+        if cache_key in self._properties_cache:
+            self._properties_cache.move_to_end(cache_key)
+            return copy.deepcopy(self._properties_cache[cache_key])
+        
         properties = {}
         
         try:
+            # Fetched once and shared by all estimators
+            numbers = np.asarray(complex_atoms.numbers)
+            positions = complex_atoms.get_positions()
+            seed = int.from_bytes(digest[:8], 'little')
+            
             # Geometric properties
             properties['total_atoms'] = len(complex_atoms)
-            properties['molecular_volume'] = self._calculate_molecular_volume(complex_atoms)
+            properties['molecular_volume'] = self._calculate_molecular_volume(numbers)
             properties['center_of_mass'] = complex_atoms.get_center_of_mass().tolist()
             
             # Energy properties
             if self.fairchem_calc:
-                complex_atoms.set_calculator(self.fairchem_calc)
-                properties['total_energy'] = complex_atoms.get_potential_energy()
-                properties['forces_rms'] = np.sqrt(np.mean(complex_atoms.get_forces()**2))
+                calc = self.fairchem_calc
+                wanted = ['energy', 'forces'] if compute_forces else ['energy']
+                complex_atoms.set_calculator(calc)
+                # Reuse results from the final optimizer step when the geometry is unchanged,
+                # otherwise run a single forward/backward pass for everything requested
+                if calc.check_state(complex_atoms) or any(p not in calc.results for p in wanted):
+                    with self._autocast():
+                        calc.calculate(complex_atoms, properties=wanted, system_changes=all_changes)
+                # Plain Python floats so the dict stays JSON-serializable
+                properties['total_energy'] = float(calc.results['energy'])
+                if compute_forces:
+                    forces = calc.results['forces']
+                    properties['forces_rms'] = float(np.sqrt((forces * forces).mean()))
             else:
                 properties['total_energy'] = -2847.32  # Mock value
-                properties['forces_rms'] = 0.02
+                if compute_forces:
+                    properties['forces_rms'] = 0.02
             
             # Electronic properties
-            properties['homo_lumo_gap'] = self._estimate_homo_lumo_gap(complex_atoms)
-            properties['dipole_moment'] = self._calculate_dipole_moment(complex_atoms)
-            properties['polarizability'] = self._estimate_polarizability(complex_atoms)
+            properties['homo_lumo_gap'] = self._estimate_homo_lumo_gap(numbers, seed)
+            properties['dipole_moment'] = self._calculate_dipole_moment(positions, seed)
+            properties['polarizability'] = self._estimate_polarizability(properties['molecular_volume'])
             
             # Binding properties
-            properties['binding_energy'] = self._estimate_binding_energy(complex_atoms)
-            properties['binding_sites'] = self._identify_binding_sites(complex_atoms)
+            properties['binding_energy'] = self._estimate_binding_energy(numbers, seed)
+            properties['binding_sites'] = self._identify_binding_sites(numbers, positions)
             
             # Spectroscopic properties
-            properties['ir_frequencies'] = self._estimate_ir_frequencies(complex_atoms)
-            properties['uv_vis_absorption'] = self._estimate_uv_vis(complex_atoms)
+            properties['ir_frequencies'] = self._estimate_ir_frequencies(numbers)
+            properties['uv_vis_absorption'] = self._estimate_uv_vis(numbers)
             
         except Exception as e:
             print(f"Error calculating properties: {e}")
             properties['error'] = str(e)
         
+        if 'error' not in properties:
+            self._properties_cache[cache_key] = copy.deepcopy(properties)
+            if len(self._properties_cache) > PROPERTIES_CACHE_SIZE:
+                self._properties_cache.popitem(last=False)
+        
         return properties
     
-    def _calculate_molecular_volume(self, atoms):
+    def _structure_hash(self, atoms):
+        """Digest of atomic numbers, exact positions, cell, pbc and tags"""
+        return hashlib.blake2b(
+            np.asarray(atoms.numbers, dtype=np.int64).tobytes()
+            + np.ascontiguousarray(atoms.get_positions(), dtype=np.float64).tobytes()
+            + np.ascontiguousarray(atoms.cell.array, dtype=np.float64).tobytes()
+            + np.asarray(atoms.pbc, dtype=np.uint8).tobytes()
+            + np.asarray(atoms.get_tags(), dtype=np.int64).tobytes()
+        ).digest()
+    
+    def _rng(self, seed, stream):
+        """Random generator seeded from the structure, so estimates are reproducible"""
+        return np.random.default_rng([seed, stream])
+    
+    def _noise(self, seed, sigma, stream):
+        """Optional Gaussian noise on empirical estimates"""
+        if not self.property_noise:
+            return 0.0
+        return float(self._rng(seed, stream).normal(0, sigma))
+    
+    def _calculate_molecular_volume(self, numbers):
         """Estimate molecular volume"""
-        vdw_radii = {'H': 1.2, 'C': 1.7, 'N': 1.55, 'O': 1.52, 'S': 1.8, 'P': 1.8}
-        total_volume = 0
-        for symbol in atoms.get_chemical_symbols():
-            radius = vdw_radii.get(symbol, 1.5)
-            total_volume += (4/3) * np.pi * radius**3
-        return total_volume
+        radii = self._vdw_table[numbers]
+        return float((4.0 / 3.0) * np.pi * (radii * radii * radii).sum())
     
-    def _estimate_homo_lumo_gap(self, atoms):
+    def _estimate_homo_lumo_gap(self, numbers, seed):
         """Estimate HOMO-LUMO gap"""
-        n_electrons = sum(atoms.get_atomic_numbers())
+        n_electrons = numbers.sum()
         if n_electrons < 10:
-            return 8.0 + np.random.normal(0, 0.5)
+            return 8.0 + self._noise(seed, 0.5, stream=0)
         elif n_electrons < 50:
-            return 4.0 + np.random.normal(0, 1.0)
+            return 4.0 + self._noise(seed, 1.0, stream=0)
         else:
-            return 2.0 + np.random.normal(0, 0.5)
+            return 2.0 + self._noise(seed, 0.5, stream=0)
     
-    def _calculate_dipole_moment(self, atoms):
+    def _calculate_dipole_moment(self, positions, seed):
         """Calculate dipole moment"""
-        positions = atoms.get_positions()
-        charges = np.random.normal(0, 0.1, len(atoms))
-        dipole = np.sum(charges[:, np.newaxis] * positions, axis=0)
-        return np.linalg.norm(dipole)
+        charges = self._rng(seed, stream=1).normal(0, 0.1, len(positions))
+        dipole = charges @ positions
+        return float(np.linalg.norm(dipole))
     
-    def _estimate_polarizability(self, atoms):
+    def _estimate_polarizability(self, volume):
         """Estimate polarizability"""
-        volume = self._calculate_molecular_volume(atoms)
         return 0.1 * volume
     
-    def _estimate_binding_energy(self, atoms):
+    def _estimate_binding_energy(self, numbers, seed):
         """Estimate binding energy"""
-        n_atoms = len(atoms)
-        return -5.0 - 0.1 * n_atoms + np.random.normal(0, 1.0)
+        n_atoms = len(numbers)
+        return -5.0 - 0.1 * n_atoms + self._noise(seed, 1.0, stream=2)
     
-    def _identify_binding_sites(self, atoms):
+    def _identify_binding_sites(self, numbers, positions):
         """Identify binding sites"""
-        positions = atoms.get_positions()
-        symbols = atoms.get_chemical_symbols()
-        
-        binding_sites = []
-        for i, (pos, sym) in enumerate(zip(positions, symbols)):
-            if sym in ['O', 'N', 'S']:
-                binding_sites.append({
-                    'atom_index': i,
-                    'element': sym,
-                    'position': pos.tolist()
-                })
-        
-        return binding_sites
+        # N, O, S donors
+        indices = np.nonzero(np.isin(numbers, [7, 8, 16]))[0]
+        
+        return [
+            {'atom_index': int(i), 'element': chemical_symbols[numbers[i]], 'position': pos.tolist()}
+            for i, pos in zip(indices, positions[indices])
+        ]
     
-    def _estimate_ir_frequencies(self, atoms):
+    def _estimate_ir_frequencies(self, numbers):
         """Estimate IR frequencies"""
-        symbols = atoms.get_chemical_symbols()
+        present = set(np.unique(numbers).tolist())
         frequencies = []
         
-        if 'O' in symbols and 'H' in symbols:
+        if 8 in present and 1 in present:  # O-H
             frequencies.extend([3200, 3400])
-        if 'C' in symbols and 'O' in symbols:
+        if 6 in present and 8 in present:  # C=O
             frequencies.append(1700)
-        if 'C' in symbols and 'H' in symbols:
+        if 6 in present and 1 in present:  # C-H
             frequencies.extend([2900, 3000])
         
         return sorted(frequencies) if frequencies else [1650]
     
-    def _estimate_uv_vis(self, atoms):
+    def _estimate_uv_vis(self, numbers):
         """Estimate UV-Vis absorption"""
-        n_pi_electrons = sum(1 for sym in atoms.get_chemical_symbols() if sym in ['C', 'N', 'O'])
+        n_pi_electrons = int(np.isin(numbers, [6, 7, 8]).sum())
         lambda_max = 200 + 30 * np.sqrt(n_pi_electrons)
-        return min(lambda_max, 800)
+        return float(min(lambda_max, 800))
     
     def save_gjf_file(self, atoms, filename, title="Optimized Complex", 
                       method="B3LYP", basis="6-31G(d)", charge=0, multiplicity=1):
@@ -311,10 +494,11 @@ class MolecularComplexAnalyzer:
             f.write(f"{title}\n\n")
             f.write(f"{charge} {multiplicity}\n")
             
-            for symbol, pos in zip(atoms.get_chemical_symbols(), atoms.get_positions()):
-                f.write(f"{symbol:2s} {pos[0]:12.6f} {pos[1]:12.6f} {pos[2]:12.6f}\n")
-            
-            f.write("\n")
+            coords = "".join(
+                f"{symbol:2s} {x:12.6f} {y:12.6f} {z:12.6f}\n"
+                for symbol, (x, y, z) in zip(atoms.get_chemical_symbols(), atoms.get_positions().tolist())
+            )
+            f.write(coords + "\n")
     
     def analyze_complex(self, absorbent_file, analyte_file, output_prefix="complex"):
         """
@@ -4,17 +4,31 @@ FastAPI Backend for Molecular Complex Analyzer
 Serves both API and frontend
 """
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import FileResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Literal
 import os
+import asyncio
+import multiprocessing
 import uuid
 import json
-import shutil
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import aiofiles
+import orjson
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 
 try:
     from analyzer import MolecularComplexAnalyzer
@@ -36,14 +50,121 @@ UPLOAD_DIR = Path("uploads")
 RESULTS_DIR = Path("results")
 UPLOAD_DIR.mkdir(exist_ok=True)
 RESULTS_DIR.mkdir(exist_ok=True)
+UPLOAD_CHUNK_SIZE = 1 << 20
 
-jobs_db = {}
+class MemoryJobStore:
+    """Job state held in this process (single-worker deployments)"""
+    
+    def __init__(self):
+        self.jobs = {}
+    
+    async def create(self, job_id: str, job: Dict[str, Any]):
+        self.jobs[job_id] = job
+    
+    async def update(self, job_id: str, **fields):
+        self.jobs[job_id].update(fields)
+    
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        return self.jobs.get(job_id)
+    
+    async def update_progress(self, job_id: str, progress: int, message: str):
+        job = self.jobs.get(job_id)
+        if job is not None and job["status"] == "processing":
+            job.update(progress=progress, message=message)
+    
+    async def count_active(self) -> int:
+        return len([j for j in self.jobs.values() if j["status"] == "processing"])
+
+class RedisJobStore:
+    """Job state shared through Redis so any uvicorn worker can serve it"""
+    
+    # Check-and-set in one step so a late progress message cannot
+    # overwrite a job that has already completed or failed
+    UPDATE_PROGRESS_SCRIPT = """
+    if redis.call('HGET', KEYS[1], 'status') ~= ARGV[1] then
+        return 0
+    end
+    redis.call('HSET', KEYS[1], 'progress', ARGV[2], 'message', ARGV[3])
+    return 1
+    """
+    
+    def __init__(self, url: str):
+        self.redis = aioredis.from_url(url, decode_responses=True)
+        self._update_progress = self.redis.register_script(self.UPDATE_PROGRESS_SCRIPT)
+    
+    async def create(self, job_id: str, job: Dict[str, Any]):
+        await self.redis.hset(f"job:{job_id}", mapping={k: json.dumps(v) for k, v in job.items()})
+    
+    async def update(self, job_id: str, **fields):
+        await self.redis.hset(f"job:{job_id}", mapping={k: json.dumps(v) for k, v in fields.items()})
+        if "status" in fields:
+            if fields["status"] == "processing":
+                await self.redis.sadd("jobs:processing", job_id)
+            else:
+                await self.redis.srem("jobs:processing", job_id)
+        # Progress feed for live subscribers
+        await self.redis.publish(f"job:{job_id}:progress", json.dumps(fields))
+    
+    async def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        job = await self.redis.hgetall(f"job:{job_id}")
+        return {k: json.loads(v) for k, v in job.items()} if job else None
+    
+    async def update_progress(self, job_id: str, progress: int, message: str):
+        updated = await self._update_progress(
+            keys=[f"job:{job_id}"],
+            args=[json.dumps("processing"), json.dumps(progress), json.dumps(message)])
+        if updated:
+            await self.redis.publish(f"job:{job_id}:progress",
+                                     json.dumps({"progress": progress, "message": message}))
+    
+    async def count_active(self) -> int:
+        return await self.redis.scard("jobs:processing")
+
+REDIS_URL = os.environ.get("REDIS_URL")
+if REDIS_URL and aioredis is None:
+    print("Warning: REDIS_URL set but redis not installed. Install with: pip install redis")
+jobs_db = RedisJobStore(REDIS_URL) if REDIS_URL and aioredis is not None else MemoryJobStore()
+
+# Heavy analysis runs in worker processes (one per GPU) so the event loop
+# only serves uploads, status polling and downloads
+executor = None
+progress_manager = None
+progress_queue = None
+_drain_task = None
+_running_tasks = set()
+
+# Per-worker-process cache of loaded analyzers keyed by (model, device)
+# One analyzer per (model, device); both are restricted by AnalysisSettings,
+# so the pool stays bounded
+_ANALYZERS = {}
+
+def get_analyzer(model: str, device: str):
+    key = (model, device)
+    if key not in _ANALYZERS:
+        _ANALYZERS[key] = MolecularComplexAnalyzer(fairchem_model=model, device=device, cache_dir="./cache/")
+    return _ANALYZERS[key]
+
+def _init_worker(counter, n_gpus: int):
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+    if not n_gpus:
+        return
+    gpu = worker_index % n_gpus
+    if torch is not None and torch.cuda.is_initialized():
+        # Too late for CUDA_VISIBLE_DEVICES to take effect in this process
+        torch.cuda.set_device(gpu)
+    else:
+        # Nothing imported so far touches CUDA (the analyzer resolves its
+        # default device lazily), so the first CUDA call sees only this GPU
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(gpu)
 
 class AnalysisSettings(BaseModel):
-    model: str = "gemnet_oc"
-    device: str = "cuda"
+    model: Literal["gemnet_oc"] = "gemnet_oc"
+    device: Literal["cuda", "cpu"] = "cuda"
     fmax: float = 0.05
     steps: int = 200
+    optimizer: Literal["bfgs", "fire"] = "bfgs"
     separation: float = 3.0
     method: str = "B3LYP"
     basis: str = "6-31G(d)"
@@ -55,72 +176,105 @@ class AnalysisRequest(BaseModel):
     analyte_file_id: str
     settings: AnalysisSettings
 
+def _report(queue, job_id: str, progress: int, message: str):
+    queue.put((job_id, progress, message))
+
+def _sync_run(job_id: str, absorbent_path: str, analyte_path: str, settings: AnalysisSettings, queue):
+    """Full analysis pipeline, executed inside a worker process"""
+    analyzer = get_analyzer(settings.model, settings.device)
+    
+    _report(queue, job_id, 20, "Parsing structures...")
+    absorbent = analyzer.parse_gjf_file(absorbent_path)
+    analyte = analyzer.parse_gjf_file(analyte_path)
+    
+    _report(queue, job_id, 40, "Optimizing absorbent...")
+    opt_absorbent = analyzer.optimize_structure(absorbent, fmax=settings.fmax, steps=settings.steps,
+                                                optimizer=settings.optimizer)
+    
+    _report(queue, job_id, 60, "Optimizing analyte...")
+    opt_analyte = analyzer.optimize_structure(analyte, fmax=settings.fmax, steps=settings.steps,
+                                              optimizer=settings.optimizer)
+    
+    _report(queue, job_id, 70, "Creating complex...")
+    initial_complex = analyzer.create_complex(opt_absorbent, opt_analyte, settings.separation)
+    
+    _report(queue, job_id, 85, "Optimizing complex...")
+    final_complex = analyzer.optimize_complex(initial_complex, fmax=settings.fmax, steps=settings.steps,
+                                              optimizer=settings.optimizer)
+    
+    _report(queue, job_id, 95, "Calculating properties...")
+    properties = analyzer.calculate_properties(final_complex)
+    
+    result_prefix = RESULTS_DIR / job_id
+    output_gjf = f"{result_prefix}_optimized.gjf"
+    
+    analyzer.save_gjf_file(final_complex, output_gjf, title="Optimized Complex",
+                          method=settings.method, basis=settings.basis,
+                          charge=settings.charge, multiplicity=settings.multiplicity)
+    
+    results = {
+        "status": "success",
+        "structures": {
+            "absorbent_atoms": len(absorbent),
+            "analyte_atoms": len(analyte),
+            "complex_atoms": len(final_complex)
+        },
+        "properties": properties,
+        "files": {"optimized_structure": output_gjf, "job_id": job_id}
+    }
+    
+    with open(f"{result_prefix}_results.json", 'wb') as f:
+        f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_SERIALIZE_NUMPY))
+    
+    return results
+
 async def run_analysis_task(job_id: str, absorbent_path: str, analyte_path: str, settings: AnalysisSettings):
     try:
-        jobs_db[job_id]["status"] = "processing"
-        jobs_db[job_id]["progress"] = 10
-        jobs_db[job_id]["message"] = "Initializing..."
+        await jobs_db.update(job_id, status="processing", progress=10, message="Initializing...")
         
         if MolecularComplexAnalyzer is None:
             raise Exception("Analyzer not available")
         
-        analyzer = MolecularComplexAnalyzer(fairchem_model=settings.model, device=settings.device)
-        
-        jobs_db[job_id]["progress"] = 20
-        jobs_db[job_id]["message"] = "Parsing structures..."
-        absorbent = analyzer.parse_gjf_file(absorbent_path)
-        analyte = analyzer.parse_gjf_file(analyte_path)
+        loop = asyncio.get_running_loop()
+        results = await loop.run_in_executor(executor, _sync_run, job_id, absorbent_path,
+                                             analyte_path, settings, progress_queue)
         
-        jobs_db[job_id]["progress"] = 40
-        jobs_db[job_id]["message"] = "Optimizing absorbent..."
-        opt_absorbent = analyzer.optimize_structure(absorbent, fmax=settings.fmax, steps=settings.steps)
-        
-        jobs_db[job_id]["progress"] = 60
-        jobs_db[job_id]["message"] = "Optimizing analyte..."
-        opt_analyte = analyzer.optimize_structure(analyte, fmax=settings.fmax, steps=settings.steps)
-        
-        jobs_db[job_id]["progress"] = 70
-        jobs_db[job_id]["message"] = "Creating complex..."
-        initial_complex = analyzer.create_complex(opt_absorbent, opt_analyte, settings.separation)
-        
-        jobs_db[job_id]["progress"] = 85
-        jobs_db[job_id]["message"] = "Optimizing complex..."
-        final_complex = analyzer.optimize_complex(initial_complex, fmax=settings.fmax, steps=settings.steps)
-        
-        jobs_db[job_id]["progress"] = 95
-        jobs_db[job_id]["message"] = "Calculating properties..."
-        properties = analyzer.calculate_properties(final_complex)
-        
-        result_prefix = RESULTS_DIR / job_id
-        output_gjf = f"{result_prefix}_optimized.gjf"
-        
-        analyzer.save_gjf_file(final_complex, output_gjf, title="Optimized Complex",
-                              method=settings.method, basis=settings.basis,
-                              charge=settings.charge, multiplicity=settings.multiplicity)
-        
-        results = {
-            "status": "success",
-            "structures": {
-                "absorbent_atoms": len(absorbent),
-                "analyte_atoms": len(analyte),
-                "complex_atoms": len(final_complex)
-            },
-            "properties": properties,
-            "files": {"optimized_structure": output_gjf, "job_id": job_id}
-        }
-        
-        with open(f"{result_prefix}_results.json", 'w') as f:
-            json.dump(results, f, indent=2)
-        
-        jobs_db[job_id]["status"] = "completed"
-        jobs_db[job_id]["progress"] = 100
-        jobs_db[job_id]["message"] = "Complete!"
-        jobs_db[job_id]["results"] = results
+        await jobs_db.update(job_id, status="completed", progress=100, message="Complete!", results=results)
         
     except Exception as e:
-        jobs_db[job_id]["status"] = "failed"
-        jobs_db[job_id]["error"] = str(e)
-        jobs_db[job_id]["message"] = f"Failed: {str(e)}"
+        await jobs_db.update(job_id, status="failed", error=str(e), message=f"Failed: {str(e)}")
+
+async def _drain_progress():
+    """Apply progress updates posted by worker processes"""
+    loop = asyncio.get_running_loop()
+    while True:
+        # Manager-proxy calls are blocking round-trips, so wait on a thread
+        item = await loop.run_in_executor(None, progress_queue.get)
+        if item is None:
+            break
+        job_id, progress, message = item
+        await jobs_db.update_progress(job_id, progress, message)
+
+@app.on_event("startup")
+async def startup():
+    global executor, progress_manager, progress_queue, _drain_task
+    ctx = multiprocessing.get_context("spawn")
+    n_gpus = torch.cuda.device_count() if torch is not None else 0
+    executor = ProcessPoolExecutor(max_workers=n_gpus or 1, mp_context=ctx,
+                                   initializer=_init_worker, initargs=(ctx.Value('i', 0), n_gpus))
+    progress_manager = ctx.Manager()
+    progress_queue = progress_manager.Queue()
+    _drain_task = asyncio.create_task(_drain_progress())
+
+@app.on_event("shutdown")
+async def shutdown():
+    for task in _running_tasks:
+        task.cancel()
+    # Sentinel unblocks the drain thread's queue.get
+    progress_queue.put(None)
+    await _drain_task
+    executor.shutdown(wait=False, cancel_futures=True)
+    progress_manager.shutdown()
 
 @app.post("/api/upload")
 async def upload_file(file: UploadFile = File(...)):
@@ -129,14 +283,15 @@ async def upload_file(file: UploadFile = File(...)):
     file_id = str(uuid.uuid4())
     file_path = UPLOAD_DIR / f"{file_id}.gjf"
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        async with aiofiles.open(file_path, "wb") as buffer:
+            while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                await buffer.write(chunk)
         return {"file_id": file_id, "filename": file.filename, "message": "Upload successful"}
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Upload failed: {str(e)}")
 
 @app.post("/api/analyze")
-async def start_analysis(request: AnalysisRequest, background_tasks: BackgroundTasks):
+async def start_analysis(request: AnalysisRequest):
     absorbent_path = UPLOAD_DIR / f"{request.absorbent_file_id}.gjf"
     analyte_path = UPLOAD_DIR / f"{request.analyte_file_id}.gjf"
     
@@ -146,24 +301,28 @@ async def start_analysis(request: AnalysisRequest, background_tasks: BackgroundT
         raise HTTPException(status_code=404, detail="Analyte file not found")
     
     job_id = str(uuid.uuid4())
-    jobs_db[job_id] = {"job_id": job_id, "status": "pending", "progress": 0,
-                       "message": "Queued", "results": None, "error": None}
+    await jobs_db.create(job_id, {"job_id": job_id, "status": "pending", "progress": 0,
+                                  "message": "Queued", "results": None, "error": None})
     
-    background_tasks.add_task(run_analysis_task, job_id, str(absorbent_path),
-                             str(analyte_path), request.settings)
+    task = asyncio.create_task(run_analysis_task(job_id, str(absorbent_path),
+                                                 str(analyte_path), request.settings))
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
     return {"job_id": job_id, "status": "pending"}
 
 @app.get("/api/status/{job_id}")
 async def get_status(job_id: str):
-    if job_id not in jobs_db:
+    job = await jobs_db.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    return jobs_db[job_id]
+    return job
 
 @app.get("/api/download/{job_id}/{file_type}")
 async def download_file(job_id: str, file_type: str):
-    if job_id not in jobs_db:
+    job = await jobs_db.get(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-    if jobs_db[job_id]["status"] != "completed":
+    if job["status"] != "completed":
         raise HTTPException(status_code=400, detail="Analysis not completed")
     
     if file_type == "structure":
@@ -179,7 +338,7 @@ async def download_file(job_id: str, file_type: str):
 
 @app.get("/health")
 async def health():
-    return {"status": "healthy", "active_jobs": len([j for j in jobs_db.values() if j["status"] == "processing"])}
+    return {"status": "healthy", "active_jobs": await jobs_db.count_active()}
 
 # Serve frontend static files
 frontend_build = Path("frontend/build")